@@ -1,18 +1,52 @@
 from fastapi import FastAPI
 from pydantic import BaseModel
-import requests
-from twilio.rest import Client
-from datetime import datetime, date
-import pytz
-import dotenv
+import httpx
+import orjson
+import ijson
+from datetime import datetime, date, time as dt_time
+from zoneinfo import ZoneInfo
 import os
-from typing import List
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from apscheduler.triggers.cron import CronTrigger
+from typing import List, Dict, Tuple, Optional, AsyncIterator, TYPE_CHECKING
+import asyncio
+import time
+import hashlib
+from functools import lru_cache
 import logging
 
-# Load env
-dotenv.load_dotenv()
+if TYPE_CHECKING:
+    from apscheduler.schedulers.asyncio import AsyncIOScheduler
+
+# Load env from beside this module (container deployments inject env directly and ship no .env)
+_ENV_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".env")
+if os.path.exists(_ENV_PATH):
+    import dotenv
+    dotenv.load_dotenv(_ENV_PATH)
+
+# apscheduler is only imported when the scheduler is enabled
+SCHEDULER_ENABLED = os.getenv("SCHEDULER_ENABLED", "1") == "1"
+
+# Config is immutable after process start: read and validate once (fail fast)
+_TENANT_ID = os.getenv("TENANT_ID")
+_CLIENT_ID = os.getenv("CLIENT_ID")
+_CLIENT_SECRET = os.getenv("CLIENT_SECRET")
+_SCOPE = os.getenv("SCOPE", "https://graph.microsoft.com/.default")
+
+_TWILIO_SID = os.getenv("TWILIO_SID")
+_TWILIO_TOKEN = os.getenv("TWILIO_TOKEN")
+_TWILIO_FROM = os.getenv("TWILIO_FROM")  # e.g., "whatsapp:+14155238886"
+_TWILIO_TO = os.getenv("TWILIO_TO")      # e.g., "whatsapp:+91XXXXXXXXXX"
+
+_required = {
+    "TENANT_ID": _TENANT_ID, "CLIENT_ID": _CLIENT_ID, "CLIENT_SECRET": _CLIENT_SECRET,
+    "TWILIO_SID": _TWILIO_SID, "TWILIO_TOKEN": _TWILIO_TOKEN,
+    "TWILIO_FROM": _TWILIO_FROM, "TWILIO_TO": _TWILIO_TO
+}
+_missing = [k for k, v in _required.items() if not v]
+if _missing:
+    raise RuntimeError(f"Missing environment variables: {', '.join(_missing)}")
+
+TOKEN_URL = f"https://login.microsoftonline.com/{_TENANT_ID}/oauth2/v2.0/token"
+TWILIO_MESSAGES_URL = f"https://api.twilio.com/2010-04-01/Accounts/{_TWILIO_SID}/Messages.json"
 
 app = FastAPI()
 logger = logging.getLogger("uvicorn.error")
@@ -22,149 +56,301 @@ class NotifyRequest(BaseModel):
     user_email: str
 
 # Timezones
-IST_TZ = pytz.timezone("Asia/Kolkata")
-UTC_TZ = pytz.utc
+IST_TZ = ZoneInfo("Asia/Kolkata")
+UTC_TZ = ZoneInfo("UTC")
 
-# ---- Core function that can be used by both scheduler and endpoint ----
-def notify_user_calendar(user_email: str) -> dict:
-    tenant_id = os.getenv("TENANT_ID")
-    client_id = os.getenv("CLIENT_ID")
-    client_secret = os.getenv("CLIENT_SECRET")
-    scope = os.getenv("SCOPE", "https://graph.microsoft.com/.default")
-
-    twilio_sid = os.getenv("TWILIO_SID")
-    twilio_token = os.getenv("TWILIO_TOKEN")
-    twilio_from = os.getenv("TWILIO_FROM")  # e.g., "whatsapp:+14155238886"
-    twilio_to = os.getenv("TWILIO_TO")      # e.g., "whatsapp:+91XXXXXXXXXX"
-
-    # Validate required env vars
-    required = {
-        "TENANT_ID": tenant_id, "CLIENT_ID": client_id, "CLIENT_SECRET": client_secret,
-        "TWILIO_SID": twilio_sid, "TWILIO_TOKEN": twilio_token,
-        "TWILIO_FROM": twilio_from, "TWILIO_TO": twilio_to
-    }
-    missing = [k for k, v in required.items() if not v]
-    if missing:
-        raise RuntimeError(f"Missing environment variables: {', '.join(missing)}")
-
-    # Step 1: Get Access Token
-    token_url = f"https://login.microsoftonline.com/{tenant_id}/oauth2/v2.0/token"
-    token_data = {
-        "grant_type": "client_credentials",
-        "client_id": client_id,
-        "client_secret": client_secret,
-        "scope": scope
-    }
-    token_resp = requests.post(token_url, data=token_data, timeout=20)
+# Shared async HTTP client: pooled connections amortize TLS handshakes across calls
+_client: Optional[httpx.AsyncClient] = None
+
+
+def get_http_client() -> httpx.AsyncClient:
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(
+            timeout=20,
+            limits=httpx.Limits(max_connections=20, max_keepalive_connections=10),
+            transport=httpx.AsyncHTTPTransport(retries=3),
+        )
+    return _client
+
+
+# Throttling retries: the transport only retries connection failures
+RETRY_STATUSES = (429, 503)
+MAX_THROTTLE_RETRIES = 3
+MAX_RETRY_DELAY = 60
+
+
+def _retry_delay(resp: httpx.Response, attempt: int) -> float:
+    # Honor Retry-After (seconds) when sent, otherwise back off exponentially
     try:
-        token_json = token_resp.json()
-    except Exception:
-        token_resp.raise_for_status()
-        token_json = {}
+        delay = float(resp.headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        delay = 0.5 * 2 ** attempt
+    return min(max(delay, 0.0), MAX_RETRY_DELAY)
 
-    access_token = token_json.get("access_token")
-    if not access_token:
-        raise RuntimeError(f"Failed to get access token: {token_json}")
 
-    # Step 2: Query Today's Calendar Events (today in IST, filter using UTC timestamps)
-    # Compute today's 00:00:00 and 23:59:59 in IST, then convert to UTC
-    today_ist = datetime.now(IST_TZ).date()
-    start_ist = IST_TZ.localize(datetime.combine(today_ist, datetime.min.time()))
-    end_ist = IST_TZ.localize(datetime.combine(today_ist, datetime.max.time().replace(microsecond=0)))
-    start_utc = start_ist.astimezone(UTC_TZ).strftime("%Y-%m-%dT%H:%M:%S")
-    end_utc = end_ist.astimezone(UTC_TZ).strftime("%Y-%m-%dT%H:%M:%S")
+async def send_with_retry(request: httpx.Request, stream: bool = False) -> httpx.Response:
+    client = get_http_client()
+    for attempt in range(MAX_THROTTLE_RETRIES):
+        resp = await client.send(request, stream=stream)
+        if resp.status_code not in RETRY_STATUSES:
+            return resp
+        delay = _retry_delay(resp, attempt)
+        await resp.aclose()
+        logger.warning(f"Throttled ({resp.status_code}) by {request.url.host}; retrying in {delay:.1f}s")
+        await asyncio.sleep(delay)
+    return await client.send(request, stream=stream)
 
-    calendar_url = f"https://graph.microsoft.com/v1.0/users/{user_email}/calendar/events"
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-        "Content-Type": "application/json"
-    }
-    params = {
-        "$filter": f"start/dateTime ge '{start_utc}' and end/dateTime le '{end_utc}'"
-    }
-    resp = requests.get(calendar_url, headers=headers, params=params, timeout=20)
+# OAuth token cache: (tenant_id, client_id, scope) -> (access_token, expiry epoch)
+_token_cache: Dict[Tuple[str, str, str], Tuple[str, float]] = {}
+_token_lock = asyncio.Lock()
+TOKEN_EXPIRY_BUFFER = 300  # refresh 5 minutes before expiry
+
+# Last sent body per recipient and user: (twilio_to, user_email) -> (body digest, send epoch)
+_last_body_hash: Dict[Tuple[str, str], Tuple[bytes, float]] = {}
+DUPLICATE_WINDOW = 600  # skip identical resends within 10 minutes
+
+
+async def get_access_token() -> str:
+    key = (_TENANT_ID, _CLIENT_ID, _SCOPE)
+    async with _token_lock:
+        cached = _token_cache.get(key)
+        if cached and cached[1] > time.time() + TOKEN_EXPIRY_BUFFER:
+            return cached[0]
+
+        token_data = {
+            "grant_type": "client_credentials",
+            "client_id": _CLIENT_ID,
+            "client_secret": _CLIENT_SECRET,
+            "scope": _SCOPE
+        }
+        token_resp = await send_with_retry(get_http_client().build_request("POST", TOKEN_URL, data=token_data))
+        try:
+            token_json = orjson.loads(token_resp.content)
+        except Exception:
+            token_resp.raise_for_status()
+            token_json = {}
+
+        access_token = token_json.get("access_token")
+        if not access_token:
+            raise RuntimeError(f"Failed to get access token: {token_json}")
+
+        _token_cache[key] = (access_token, time.time() + float(token_json.get("expires_in", 3600)))
+        return access_token
+
+
+def parse_graph_datetime(start_raw: Optional[str]) -> Optional[datetime]:
+    # Graph returns 'YYYY-MM-DDTHH:MM:SS.fffffff'; fromisoformat handles at most 6 fractional digits
+    if not start_raw:
+        return None
+    s = start_raw.rstrip("Z")
+    if len(s) > 26 and s[19] == ".":
+        s = s[:26]
+    try:
+        return datetime.fromisoformat(s).replace(tzinfo=None)
+    except ValueError:
+        pass
     try:
-        data = resp.json()
-    except Exception:
-        resp.raise_for_status()
-        data = {}
+        return datetime(int(s[:4]), int(s[5:7]), int(s[8:10]), int(s[11:13]), int(s[14:16]), int(s[17:19]))
+    except ValueError:
+        return None
+
+
+@lru_cache(maxsize=2)
+def today_utc_bounds(today_iso: str) -> Tuple[str, str]:
+    # Compute the day's 00:00:00 and 23:59:59 in IST, then convert to UTC
+    today_ist = date.fromisoformat(today_iso)
+    start_ist = datetime.combine(today_ist, dt_time.min, tzinfo=IST_TZ)
+    end_ist = datetime.combine(today_ist, dt_time.max.replace(microsecond=0), tzinfo=IST_TZ)
+    start_utc = start_ist.astimezone(UTC_TZ).strftime("%Y-%m-%dT%H:%M:%S")
+    end_utc = end_ist.astimezone(UTC_TZ).strftime("%Y-%m-%dT%H:%M:%S")
+    return start_utc, end_utc
 
-    if resp.status_code >= 400:
-        raise RuntimeError(f"Graph API error {resp.status_code}: {data}")
 
-    events = data.get("value", [])
-    event_list: List[str] = []
-    for event in events:
+async def format_events(events: AsyncIterator[dict]) -> AsyncIterator[str]:
+    async for event in events:
         subject = event.get("subject", "(No subject)")
 
-        # Parse start time: Graph typically returns UTC or includes timeZone field
+        # Start time is already in IST (requested via the Prefer: outlook.timezone header)
         start_raw = event.get("start", {}).get("dateTime")
-        # Try multiple formats
-        dt_obj = None
-        for fmt in ("%Y-%m-%dT%H:%M:%S.%f0", "%Y-%m-%dT%H:%M:%S.%f", "%Y-%m-%dT%H:%M:%S"):
-            try:
-                dt_obj = datetime.strptime(start_raw, fmt)
-                break
-            except Exception:
-                continue
-        if dt_obj is None:
-            # Fallback: try fromisoformat if available
-            try:
-                dt_obj = datetime.fromisoformat(start_raw.replace("Z", "+00:00")).replace(tzinfo=None)
-            except Exception:
-                dt_obj = None
-
-        # Assume UTC if no timezone, then convert to IST
-        if dt_obj is not None:
-            start_utc_dt = UTC_TZ.localize(dt_obj)
-            start_ist_dt = start_utc_dt.astimezone(IST_TZ)
-            start_str = start_ist_dt.strftime("%Y-%m-%d %H:%M:%S %Z")
+        start_ist_dt = parse_graph_datetime(start_raw)
+
+        if start_ist_dt is not None:
+            # Integer formatting avoids strftime's locale lookup; tzname is always IST here
+            start_str = (
+                f"{start_ist_dt.year:04d}-{start_ist_dt.month:02d}-{start_ist_dt.day:02d} "
+                f"{start_ist_dt.hour:02d}:{start_ist_dt.minute:02d}:{start_ist_dt.second:02d} IST"
+            )
         else:
             start_str = start_raw or "Unknown time"
 
         status = event.get("responseStatus", {}).get("response", "Unknown")
-        event_list.append(f"{subject} at {start_str} - Status: {status}")
+        yield f"{subject} at {start_str} - Status: {status}"
+
+
+class _AsyncByteReader:
+    # Minimal async file-like wrapper so ijson can consume an httpx byte stream
+    def __init__(self, chunks: AsyncIterator[bytes]):
+        self._chunks = chunks
+
+    async def read(self, size: int = -1) -> bytes:
+        if size == 0:
+            return b""
+        try:
+            return await self._chunks.__anext__()
+        except StopAsyncIteration:
+            return b""
+
+
+async def stream_events(url: str, headers: dict, params: Optional[dict]) -> AsyncIterator[dict]:
+    # Parse events incrementally as bytes arrive instead of materializing the whole payload,
+    # following @odata.nextLink when Graph pages the result
+    next_url: Optional[str] = url
+    while next_url:
+        resp = await send_with_retry(
+            get_http_client().build_request("GET", next_url, headers=headers, params=params), stream=True
+        )
+        try:
+            if resp.status_code >= 400:
+                await resp.aread()
+                try:
+                    data = orjson.loads(resp.content)
+                except Exception:
+                    data = resp.text
+                raise RuntimeError(f"Graph API error {resp.status_code}: {data}")
+
+            # nextLink already carries the query string
+            next_url, params = None, None
+            builder: Optional[ijson.ObjectBuilder] = None
+            async for prefix, event, value in ijson.parse(_AsyncByteReader(resp.aiter_bytes())):
+                if prefix == "@odata.nextLink" and event == "string":
+                    next_url = value
+                elif prefix == "value.item" and event == "start_map":
+                    builder = ijson.ObjectBuilder()
+                if builder is not None:
+                    builder.event(event, value)
+                    if prefix == "value.item" and event == "end_map":
+                        yield builder.value
+                        builder = None
+        finally:
+            await resp.aclose()
+
+
+@lru_cache(maxsize=32)
+def calendar_view_url(user_email: str) -> str:
+    # calendarView expands recurring series into today's occurrences
+    return f"https://graph.microsoft.com/v1.0/users/{user_email}/calendarView"
+
+
+# ---- Core function that can be used by both scheduler and endpoint ----
+async def notify_user_calendar(user_email: str) -> dict:
+    # Step 1: Get Access Token (cached until shortly before expiry)
+    access_token = await get_access_token()
+
+    # Step 2: Query Today's Calendar Events (today in IST, filter using UTC timestamps)
+    start_utc, end_utc = today_utc_bounds(datetime.now(IST_TZ).date().isoformat())
+
+    calendar_url = calendar_view_url(user_email)
+    headers = {
+        "Authorization": f"Bearer {access_token}",
+        "Content-Type": "application/json",
+        "Prefer": 'outlook.timezone="India Standard Time", odata.maxpagesize=200'
+    }
+    params = {
+        "startDateTime": start_utc,
+        "endDateTime": end_utc,
+        "$select": "subject,start,responseStatus",
+        "$top": "200"
+    }
+    event_list: List[str] = [
+        line async for line in format_events(stream_events(calendar_url, headers, params))
+    ]
 
     if event_list:
         body = "Today's scheduled meetings:\n" + "\n".join(event_list)
     else:
         body = "No meetings scheduled for today."
 
-    # Step 3: Send WhatsApp Notification
-    client = Client(twilio_sid, twilio_token)
-    msg = client.messages.create(
-        body=body,
-        from_=twilio_from,
-        to=twilio_to
-    )
+    # Skip the send if this exact body for this user already went to the recipient recently.
+    # The entry is reserved before awaiting the send so concurrent identical calls don't both send.
+    body_hash = hashlib.blake2b(body.encode(), digest_size=16).digest()
+    dedup_key = (_TWILIO_TO, user_email)
+    last = _last_body_hash.get(dedup_key)
+    if last and last[0] == body_hash and last[1] > time.time() - DUPLICATE_WINDOW:
+        return {"message": "skipped-duplicate", "sid": None, "events": event_list}
+    _last_body_hash[dedup_key] = (body_hash, time.time())
+
+    # Step 3: Send WhatsApp Notification (Twilio Messages API, on the shared client)
+    try:
+        msg_resp = await get_http_client().post(
+            TWILIO_MESSAGES_URL,
+            data={"Body": body, "From": _TWILIO_FROM, "To": _TWILIO_TO},
+            auth=(_TWILIO_SID, _TWILIO_TOKEN)
+        )
+        try:
+            msg_json = msg_resp.json()
+        except Exception:
+            msg_resp.raise_for_status()
+            msg_json = {}
+
+        if msg_resp.status_code >= 400:
+            raise RuntimeError(f"Twilio API error {msg_resp.status_code}: {msg_json}")
+    except BaseException:
+        # Send failed: release the reservation so a retry isn't suppressed
+        if last is None:
+            _last_body_hash.pop(dedup_key, None)
+        else:
+            _last_body_hash[dedup_key] = last
+        raise
 
-    return {"message": "WhatsApp notification sent", "sid": msg.sid, "events": event_list}
+    return {"message": "WhatsApp notification sent", "sid": msg_json.get("sid"), "events": event_list}
 
 
 # ---- Optional endpoint to trigger on-demand ----
 @app.post("/notify")
-def notify(request: NotifyRequest):
-    result = notify_user_calendar(request.user_email)
+async def notify(request: NotifyRequest):
+    result = await notify_user_calendar(request.user_email)
     return result
 
 
 # ---- Scheduler setup: run daily at 06:30 IST ----
-scheduler = AsyncIOScheduler(timezone=IST_TZ)
+scheduler: Optional["AsyncIOScheduler"] = None
+SCHEDULED_CONCURRENCY = 10  # stay well below Graph's per-app throttling threshold
 
-def scheduled_job():
-    # Choose a default email to monitor from env, or set here
-    default_email = os.getenv("DEFAULT_USER_EMAIL")
-    if not default_email:
-        logger.error("DEFAULT_USER_EMAIL not set; skipping scheduled job.")
+async def scheduled_job():
+    # Comma-separated emails to monitor from env (DEFAULT_USER_EMAIL kept for single-user setups)
+    raw_emails = os.getenv("DEFAULT_USER_EMAILS") or os.getenv("DEFAULT_USER_EMAIL", "")
+    emails = [e.strip() for e in raw_emails.split(",") if e.strip()]
+    if not emails:
+        logger.error("DEFAULT_USER_EMAILS not set; skipping scheduled job.")
         return
-    try:
-        result = notify_user_calendar(default_email)
-        logger.info(f"Scheduled notify sent: {result.get('sid')}, events={len(result.get('events', []))}")
-    except Exception as e:
-        logger.exception(f"Scheduled notify failed: {e}")
+
+    # Fan out concurrently, bounded so Graph throttling stays under control
+    sem = asyncio.Semaphore(SCHEDULED_CONCURRENCY)
+
+    async def _one(email: str) -> dict:
+        async with sem:
+            return await notify_user_calendar(email)
+
+    results = await asyncio.gather(*[_one(e) for e in emails], return_exceptions=True)
+    for email, result in zip(emails, results):
+        if isinstance(result, Exception):
+            logger.error(f"Scheduled notify failed for {email}: {result}", exc_info=result)
+        else:
+            logger.info(f"Scheduled notify for {email}: {result.get('message')} {result.get('sid')}, events={len(result.get('events', []))}")
 
 @app.on_event("startup")
-def start_scheduler():
+async def start_scheduler():
+    global scheduler
+    get_http_client()
+    if not SCHEDULER_ENABLED:
+        logger.info("Scheduler disabled (SCHEDULER_ENABLED != 1)")
+        return
+
+    from apscheduler.schedulers.asyncio import AsyncIOScheduler
+    from apscheduler.triggers.cron import CronTrigger
+
+    scheduler = AsyncIOScheduler(timezone=IST_TZ)
     # Run every day at 06:30 IST
     trigger = CronTrigger(hour=6, minute=30, timezone=IST_TZ)
     scheduler.add_job(scheduled_job, trigger, id="daily_notify_0630_ist", replace_existing=True)
@@ -173,5 +359,10 @@ def start_scheduler():
 
 
 @app.on_event("shutdown")
-def shutdown_scheduler():
-    scheduler.shutdown(wait=False)
+async def shutdown_scheduler():
+    global _client
+    if scheduler is not None:
+        scheduler.shutdown(wait=False)
+    if _client is not None:
+        await _client.aclose()
+        _client = None